@@ -3,6 +3,7 @@ import time
 import os
 import osmnx as ox
 from igo import *
+from sessions import SessionStore
 
 from staticmap import StaticMap, CircleMarker
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
@@ -12,21 +13,26 @@ from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 # ("digraph"), the list of highways ("highways") and congestions
 # ("congestions") that we take from the "opendata-ajuntament.barcelona.cat" and
 # the intelligent graph ("igraph") that we build depending on the congestions
-# of the moment.
+# of the moment and the speed model ("speed_model").
 # We save this data on global variables so that every user can access to them.
 # The list of congestions and consecuently, the intelligent graph, need to be
 # updated every five minutes as we have new data for the congestions in
 # Barcelona.
 # We will have another golbal variable, "time_last_update" where we save the
 # time when we do thi s update.
+# The sessions of the users ("sessions") are also saved in a global variable.
+# They keep the location of every user, its nearest node and its last route,
+# and they are saved in a file so that they are not lost when the bot restarts.
 
 print("Downloading data")
 graph = obtain_graph(PLACE, GRAPH_FILENAME)
 digraph = obtain_digraph(graph, DIGRAPH_FILENAME)
 highways = download_highways(HIGHWAYS_URL)
 congestions = download_congestions(CONGESTIONS_URL)
-igraph = build_igraph(digraph, highways, congestions)
+speed_model = obtain_speed_model(SPEEDS_FILENAME)
+igraph = build_igraph(digraph, highways, congestions, speed_model)
 time_last_update = time.time()
+sessions = SessionStore()
 print("Everything is ready")
 
 
@@ -37,11 +43,15 @@ def update_fields():
     """
     global congestions, igraph, time_last_update
     congestions = download_congestions(CONGESTIONS_URL)
-    igraph = build_igraph(digraph, highways, congestions)
+    igraph = build_igraph(digraph, highways, congestions, speed_model)
 
     # It saves the time when this update has been done
     time_last_update = time.time()
 
+    # It deletes the expired sessions and shows the sessions metrics
+    sessions.purge()
+    print("sessions:", sessions.metrics())
+
 
 def need_to_be_updated():
     """Function that determines whether our database of congestions needs to be
@@ -134,9 +144,9 @@ def save_ubi(update, context):
             photo=open(file, 'rb'))
         os.remove(file)
 
-        # It saves the user location in a user variable so that it can be used
-        # in other functions.
-        context.user_data['actual_ubi'] = (lat, lon)
+        # It saves the user location and its nearest node in the user session
+        # so that they can be used in other functions.
+        _save_location(update.effective_chat.id, (lat, lon))
 
     except Exception as e:
         print(e)
@@ -146,6 +156,16 @@ def save_ubi(update, context):
             " again")
 
 
+def _save_location(chat_id, ubi):
+    """Function that saves the location "ubi" as the location of the user of
+    the chat "chat_id", together with its nearest node of the igraph. The last
+    route of the user is forgotten as it doesn't start from this location.
+    """
+    node = get_nearest_node(igraph, ubi)
+    sessions.update(chat_id, actual_ubi=ubi, node=node, route=None,
+                    route_time=None)
+
+
 def go(update, context):
     """Function that reads a position and sends an image with the fastest path
     to reach this position from the actual user location. It also says what is
@@ -160,18 +180,41 @@ def go(update, context):
         for arg in context.args:
             pos = pos + ' ' + arg
         destination_pos = ox.geocode(pos)
-        context.user_data['desti_ubi'] = destination_pos
+
+        # It reads the user session, which needs to have a location
+        chat_id = update.effective_chat.id
+        session = sessions.get(chat_id)
+        if session is None or session.node is None:
+            context.bot.send_message(
+                chat_id=chat_id,
+                text="Send me your location with /where or /pos before " +
+                "using /go.")
+            return
 
         # If necessary, it actualizes the congestions data and the igraph
         if need_to_be_updated():
             update_fields()
 
-        # It calculates the fastest path
-        origin = context.user_data['actual_ubi']
-        destination = context.user_data['desti_ubi']
-        ipath = get_shortest_path_with_ispeeds(igraph, origin, destination)
+        # It calculates the fastest path from the node saved in the session.
+        # If the last route starts at this node, ends at the destination and
+        # the igraph has not been updated since, it is used again.
+        destination = get_nearest_node(igraph, destination_pos)
+        if (session.desti_node == destination and session.route is not None
+                and session.route[0] == session.node
+                and session.route_time >= time_last_update):
+            ipath = session.route
+        else:
+            ipath = get_shortest_path_between_nodes(igraph, session.node,
+                                                    destination)
+
+            # The route is only saved if the user location has not changed
+            # while it was computed (with /pos or sending a new location).
+            sessions.update_if(chat_id, {'node': session.node},
+                               desti_ubi=destination_pos,
+                               desti_node=destination, route=ipath,
+                               route_time=time.time())
         idistance = get_path_length(igraph, ipath)
-        itime = get_path_time(igraph, origin, destination)
+        itime = get_path_itime(igraph, ipath)
         idistance = round(idistance/1000, 2)
         itime = round(itime/60, 2)
         print("length =", idistance, "km")
@@ -232,9 +275,9 @@ def pos(update, context):
             photo=open(file, 'rb'))
         os.remove(file)
 
-        # It saves this location as the user location in a user variable so
+        # It saves this location as the user location in the user session so
         # that it can be used in other functions.
-        context.user_data['actual_ubi'] = initial_pos
+        _save_location(update.effective_chat.id, initial_pos)
 
     except Exception as e:
         print(e)
@@ -263,4 +306,7 @@ def main():
     updater.start_polling()
     updater.idle()
 
+    # We close the sessions database when the Bot is turned off
+    sessions.close()
+
 main()
@@ -0,0 +1,254 @@
+import os
+import time
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.linear_model import Ridge
+from igo import *
+
+SNAPSHOTS_DIRECTORY = 'snapshots'
+# Maximum time between an observation and the last congestions snapshot to
+# consider that the snapshot describes the state of the tramo.
+SNAPSHOT_TOLERANCE = pd.Timedelta(minutes=15)
+# Number of days at the end of the observations kept out of the fit to
+# evaluate the speed model, when no split date is given.
+TEST_DAYS = 7
+
+
+# This module calibrates, offline, the speed model used to compute the "itime"
+# of the edges of the igraph. It needs:
+# - The archived congestion snapshots, saved in a directory with the function
+#   "archive_congestions" of igo.py (for example, every five minutes).
+# - A CSV file with observed travel times of the tramos. Its columns are:
+#   way_id, time (a code like the one of the congestions) and seconds.
+# The model is fitted with the observations before a split date and evaluated
+# with the ones from this date on, so that the reported error is measured on
+# data not used in the fit. By default, the split date leaves the last
+# TEST_DAYS days of the observations out of the fit.
+# Usage:
+#   python calibrate.py archive [directory]
+#   python calibrate.py fit observations.csv [directory] [--split YYYYMMDD]
+#   python calibrate.py evaluate observations.csv [directory] [--split ...]
+
+
+def load_snapshots(directory):
+    """Function that loads all the congestion snapshots saved in the given
+    "directory" and returns a DataFrame with the way_id, the time and the
+    actual state of every congestion.
+    """
+    congestions = []
+    for file_name in sorted(os.listdir(directory)):
+        congestions += load_congestions(os.path.join(directory, file_name))
+    snapshots = pd.DataFrame(congestions, columns=Congestion._fields)
+    snapshots['time'] = pd.to_datetime(snapshots['time'],
+                                       format='%Y%m%d%H%M%S')
+    snapshots = snapshots.rename(columns={'actual_state': 'state'})
+    return snapshots[['way_id', 'time', 'state']]
+
+
+def load_observations(file_name):
+    """Function that loads the observed travel times of the tramos from the
+    CSV file named "file_name" and returns them in a DataFrame.
+    """
+    observations = pd.read_csv(file_name, dtype={'way_id': str, 'time': str})
+    observations['time'] = pd.to_datetime(observations['time'],
+                                          format='%Y%m%d%H%M%S')
+    return observations[['way_id', 'time', 'seconds']]
+
+
+def split_observations(observations, split=None):
+    """Function that splits the "observations" in the ones before the "split"
+    date (a string like YYYYMMDD) and the ones from this date on. If no date
+    is given, the last TEST_DAYS days of the observations are split.
+    Returns the two DataFrames and the split date.
+    """
+    if split is None:
+        last_day = observations['time'].max().normalize()
+        split_time = last_day - pd.Timedelta(days=TEST_DAYS-1)
+    else:
+        split_time = pd.to_datetime(split, format='%Y%m%d')
+    before = observations[observations['time'] < split_time]
+    after = observations[observations['time'] >= split_time]
+    return before, after, split_time
+
+
+def tramos_digraph(highways):
+    """Function that returns the digraph of the city with the way_id of the
+    tramo of every edge, spread from the "highways" in the same way as the
+    bot does it.
+    """
+    graph = obtain_graph(PLACE, GRAPH_FILENAME)
+    digraph = obtain_digraph(graph, DIGRAPH_FILENAME)
+    congestions = download_congestions(CONGESTIONS_URL)
+    return spread_congestions(digraph, highways, congestions)
+
+
+def _free_flow_times(digraph):
+    """Function that returns a dictionary with the time in seconds needed to
+    travel through every tramo of the "digraph" at the maximum speed of its
+    edges. It is computed as the d/v of "new_itime_attribute", so that it is
+    the same time that the factors of the speed model multiply in the bot.
+    """
+    times = collections.defaultdict(float)
+    for node1, node2, edge in digraph.edges(data=True):
+        if edge.get("way_id") is not None:
+            v = _maxspeed(edge) * (1000/3600)  # conversion factor to m/s
+            times[edge["way_id"]] += float(edge["length"]) / v
+    return dict(times)
+
+
+def _join(digraph, snapshots, observations):
+    """Function that returns a DataFrame with an observation of the travel
+    time of a tramo in every row, together with the congestion state of the
+    tramo at that moment, the hour of the day and the free flow time.
+    The observations without congestion data are discarded.
+    """
+    data = pd.merge_asof(observations.sort_values('time'),
+                         snapshots.sort_values('time'), on='time',
+                         by='way_id', direction='backward',
+                         tolerance=SNAPSHOT_TOLERANCE)
+    data['free_flow'] = data['way_id'].map(_free_flow_times(digraph))
+    data = data.dropna(subset=['state', 'free_flow'])
+    data = data[(data['free_flow'] > 0) & (data['seconds'] > 0)].copy()
+    data['state'] = data['state'].astype(int)
+    data['hour'] = data['time'].dt.hour
+    return data.reset_index(drop=True)
+
+
+def fit_speed_model(digraph, snapshots, observations, alpha=1.0):
+    """Function that fits a speed model from the archived congestion
+    "snapshots" and the "observations" of the travel times of the tramos of
+    the "digraph".
+    The logarithm of the ratio between the observed time and the free flow
+    time is modelled as the sum of a term for every congestion state and a
+    term for every tramo and hour of the day, fitted with a ridge regression
+    of parameter "alpha" so that the tramos and hours with few observations
+    stay close to the common factors.
+    """
+    data = _join(digraph, snapshots, observations)
+    if len(data) == 0:
+        raise ValueError("No observations with congestion data to fit the "
+                         "speed model")
+    way_ids = np.array(sorted(data['way_id'].unique()))
+    rows = {way_id: i for i, way_id in enumerate(way_ids)}
+
+    # Every observation has a 1 in the column of its congestion state and in
+    # the column of its tramo and hour.
+    n = len(data)
+    tramos = data['way_id'].map(rows).to_numpy()
+    hour_columns = N_STATES + tramos*HOURS + data['hour'].to_numpy()
+    columns = np.concatenate([data['state'].to_numpy(), hour_columns])
+    lines = np.concatenate([np.arange(n), np.arange(n)])
+    X = scipy.sparse.csr_matrix((np.ones(2*n), (lines, columns)),
+                                shape=(n, N_STATES + len(way_ids)*HOURS))
+    y = np.log(data['seconds'].to_numpy() / data['free_flow'].to_numpy())
+    regression = Ridge(alpha=alpha).fit(X, y)
+
+    # The row 0 (edges without tramo) only has the common factors.
+    states = regression.coef_[:N_STATES]
+    hours = np.vstack([np.zeros((1, HOURS)),
+                       regression.coef_[N_STATES:].reshape(-1, HOURS)])
+    factors = np.exp(regression.intercept_ + hours[:, :, None] +
+                     states[None, None, :])
+
+    # The states without observations keep their default factor, and a closed
+    # tramo ("tallat") is never calibrated.
+    default = default_speed_model().factors[0, 0]
+    observed = set(data['state'])
+    for state in range(N_STATES):
+        if state == 6 or state not in observed:
+            factors[:, :, state] = default[state]
+    return SpeedModel(way_ids, factors)
+
+
+def refresh_cost(model, digraph, repeat=5):
+    """Function that returns the mean time in seconds needed to compute the
+    "itime" of all the edges of the "digraph" with the given speed "model",
+    which is the cost that the model adds to every update of the igraph.
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        new_itime_attribute(digraph, model, 0)
+    return (time.perf_counter() - start) / repeat
+
+
+def evaluate_speed_model(model, digraph, snapshots, observations):
+    """Function that evaluates a speed "model" comparing the times that the
+    bot would predict for the "observations" of the travel times of the
+    tramos of the "digraph" with the observed ones. Returns a dictionary with
+    the number of observations used, the mean absolute error in seconds, the
+    mean absolute percentage error and the same errors for the default speed
+    model. It also returns the size of the saved model in bytes and its
+    refresh cost.
+    """
+    data = _join(digraph, snapshots, observations)
+    way_ids = data['way_id'].tolist()
+    states = data['state'].to_numpy()
+    hours = data['hour'].to_numpy()
+    observed = data['seconds'].to_numpy()
+
+    result = {'observations': len(data),
+              'bytes': model.factors.astype(np.float32).nbytes}
+    for name, m in [('model', model), ('default', default_speed_model())]:
+        predicted = data['free_flow'].to_numpy() * \
+            speed_factors(m, way_ids, states, hours)
+        result[name + '_mae'] = float(np.mean(np.abs(predicted - observed)))
+        result[name + '_mape'] = \
+            float(np.mean(np.abs(predicted - observed) / observed)) * 100
+    result['refresh_seconds'] = refresh_cost(model, digraph)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibration of the speed "
+                                     "model of iGo.")
+    parser.add_argument('command', choices=['archive', 'fit', 'evaluate'])
+    parser.add_argument('files', nargs='*',
+                        help="observations.csv [directory] for fit and "
+                        "evaluate, [directory] for archive")
+    parser.add_argument('--split', help="first day (YYYYMMDD) of the "
+                        "observations used to evaluate the model")
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        directory = args.files[0] if args.files else SNAPSHOTS_DIRECTORY
+        print(archive_congestions(CONGESTIONS_URL, directory))
+        return
+
+    if not args.files:
+        parser.error("the observations file is needed")
+    directory = args.files[1] if len(args.files) > 1 else SNAPSHOTS_DIRECTORY
+    observations = load_observations(args.files[0])
+
+    # The model is only fitted with the observations before the split date
+    # and only evaluated with the ones from this date on.
+    train, test, split_time = split_observations(observations, args.split)
+    split_day = split_time.strftime('%Y%m%d')
+    print("split =", split_day)
+    if args.command == 'fit' and len(train) == 0:
+        parser.error("there are no observations before " + split_day +
+                     " to fit the model, pass a later date with --split")
+    if args.command == 'evaluate' and len(test) == 0:
+        parser.error("there are no observations from " + split_day +
+                     " on to evaluate the model, pass an earlier date with "
+                     "--split")
+
+    highways = download_highways(HIGHWAYS_URL)
+    digraph = tramos_digraph(highways)
+    snapshots = load_snapshots(directory)
+
+    if args.command == 'fit':
+        model = fit_speed_model(digraph, snapshots, train)
+        save_speed_model(model, SPEEDS_FILENAME)
+        print("Speed model saved in", SPEEDS_FILENAME)
+    elif args.command == 'evaluate':
+        model = obtain_speed_model(SPEEDS_FILENAME)
+        result = evaluate_speed_model(model, digraph, snapshots, test)
+        for key, value in result.items():
+            print(key, "=", value)
+
+
+if __name__ == '__main__':
+    main()
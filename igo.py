@@ -6,12 +6,19 @@ import staticmap
 import urllib
 import osmnx as ox
 import collections
+import os
+import time
+import numpy as np
 import pandas as pd
 
 PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
 DIGRAPH_FILENAME = 'barcelona.digraph'
+SPEEDS_FILENAME = 'barcelona.speeds.npz'
 SIZE = 800
+DEFAULT_SPEED = 50  # km/h
+N_STATES = 7
+HOURS = 24
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
 
@@ -26,6 +33,13 @@ Highway = collections.namedtuple('Highway', 'way_id name coordinates')
 Congestion = collections.namedtuple('Congestion', 'way_id time actual_state \
 expected_state')
 
+# We define this tuple to save a speed model. For every tramo, we save its
+# way_id in "way_ids" and in "factors" a table with the factor that multiplies
+# the time of its edges for every hour of the day and every congestion state.
+# The row i+1 of "factors" corresponds to the tramo "way_ids[i]" and the row 0
+# is used for the edges that don't belong to any tramo.
+SpeedModel = collections.namedtuple('SpeedModel', 'way_ids factors')
+
 
 def obtain_graph(PLACE, file_name):
     """Function that returns a graph from de given "PLACE". It tries to load it
@@ -167,15 +181,53 @@ def download_congestions(CONGESTIONS_URL):
     """
     with urllib.request.urlopen(CONGESTIONS_URL) as response:
         lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#', quotechar='"')
+        return _read_congestions(lines)
 
-        # It creates an empty list in which it appends each congestion info
-        congestions = []
-        for line in reader:
-            way_id, code, actual_state, expected_state = line
-            congestions.append(Congestion(way_id, code, int(actual_state),
-                               int(expected_state)))
-        return congestions
+
+def _read_congestions(lines):
+    """Function that given the "lines" of a congestions file, returns a list
+    with all the congestions.
+    """
+    reader = csv.reader(lines, delimiter='#', quotechar='"')
+
+    # It creates an empty list in which it appends each congestion info
+    congestions = []
+    for line in reader:
+        way_id, code, actual_state, expected_state = line
+        congestions.append(Congestion(way_id, code, int(actual_state),
+                           int(expected_state)))
+    return congestions
+
+
+def load_congestions(file_name):
+    """Function that loads the congestions from the file named "file_name" and
+    returns a list with all of them.
+    """
+    with open(file_name, encoding='utf-8') as file:
+        return _read_congestions(file.readlines())
+
+
+def archive_congestions(CONGESTIONS_URL, directory):
+    """Function that downloads the congestions from a given URL
+    ("CONGESTIONS_URL") and saves them, as they are, in a new file of the
+    given "directory", which is created if it doesn't exist. These snapshots
+    are used to calibrate the speed model. Returns the name of the file.
+    """
+    with urllib.request.urlopen(CONGESTIONS_URL) as response:
+        data = response.read()
+
+    # If there are no congestions, there is nothing to archive
+    congestions = _read_congestions(data.decode('utf-8').splitlines())
+    if len(congestions) == 0:
+        raise ValueError("No congestions downloaded from " + CONGESTIONS_URL)
+
+    # The file is named with the code of the collection of the data, so that
+    # downloading twice the same data only keeps one copy of it.
+    os.makedirs(directory, exist_ok=True)
+    file_name = os.path.join(directory, congestions[0].time + '.csv')
+    with open(file_name, 'wb') as file:
+        file.write(data)
+    return file_name
 
 
 def _show_congestions(congestions):
@@ -242,10 +294,81 @@ def _factor(congestion):
         return 10000000
 
 
+def default_speed_model():
+    """Function that returns the speed model that doesn't depend on the tramo
+    nor the hour: the factor of every congestion state is the one given by
+    "_factor", multiplied by 2 in order to consider other factors as traffic
+    lights or pedestrians.
+    It is used when we don't have a calibrated speed model.
+    """
+    row = np.array([_factor(c) * 2 for c in range(N_STATES)], dtype=float)
+    factors = np.tile(row, (1, HOURS, 1))
+    return SpeedModel(np.array([], dtype=str), factors)
+
+
+def save_speed_model(model, file_name):
+    """Function that saves a given speed "model" in a file named as the
+    parameter "file_name". The factors are saved in simple precision so that
+    the file is smaller.
+    """
+    np.savez_compressed(file_name, way_ids=model.way_ids,
+                        factors=model.factors.astype(np.float32))
+
+
+def load_speed_model(file_name):
+    """Function that loads a speed model from the file named "file_name" and
+    returns it.
+    """
+    with np.load(file_name) as data:
+        return SpeedModel(data['way_ids'], data['factors'])
+
+
+def obtain_speed_model(file_name):
+    """Function that returns the speed model saved in the file called
+    "file_name". If not possible, it returns the default speed model.
+    """
+    if not exists_graph(file_name):
+        return default_speed_model()
+    return load_speed_model(file_name)
+
+
+def speed_factors(model, way_ids, states, hours):
+    """Function that given a speed "model", returns an array with the factor
+    of every element, given the "way_ids" of their tramos (None if they don't
+    belong to any tramo), their congestion "states" and the "hours" of the
+    day. "hours" can be a single hour or an array with one hour per element.
+    """
+    # The tramos that are not in the model use the row 0 of the table
+    rows = {way_id: i+1 for i, way_id in enumerate(model.way_ids)}
+    tramos = np.array([rows.get(way_id, 0) for way_id in way_ids], dtype=int)
+    states = np.clip(np.asarray(states, dtype=int), 0, N_STATES-1)
+    return model.factors[tramos, hours, states]
+
+
+def _congestions_hour(congestions):
+    """Function that returns the hour of the day of the collection of the
+    "congestions". If there are no congestions, it returns the actual hour.
+    """
+    if len(congestions) == 0:
+        return time.localtime().tm_hour
+    return int(congestions[0].time[8:10])
+
+
+def _maxspeed(edge):
+    """Function that returns the maximum speed of an "edge" in km/h. As for
+    every edge we don't have the "maxspeed" attribute, we will consider that
+    if it doesn't exists, the maxspeed is DEFAULT_SPEED.
+    """
+    try:
+        return float(edge["maxspeed"])
+    except:
+        return DEFAULT_SPEED
+
+
 def spread_congestions(digraph, highways, congestions):
     """Function that spreads the congestions of the highways to the edges of
-    the osmnx graph. Returns the same "digraph" with a new attribute on its
-    edges containing the "congestions" value of the "highways".
+    the osmnx graph. Returns the same "digraph" with two new attributes on its
+    edges containing the "congestions" value and the way_id of the "highways".
     """
     # As we don't have congestion data in the osmnx graph, we spread the
     # congestions of the highways data on it
@@ -259,19 +382,22 @@ def spread_congestions(digraph, highways, congestions):
         n_dest = ox.nearest_nodes(digraph, c_dest[0], c_dest[1])
 
         # If it exists a path within these two nodes, then all the edges of
-        # this path will have the same congestion as the highway.
+        # this path will have the same congestion as the highway and will
+        # belong to its tramo.
         # Otherwise, nothing is done.
         try:
             path = nx.shortest_path(digraph, n_ori, n_dest, "length")
             for k in range(len(path)-1):
                 congestion = congestions[i].actual_state
-                digraph.edges[path[k], path[k+1]]["congestion"] = congestion
+                edge = digraph.edges[path[k], path[k+1]]
+                edge["congestion"] = congestion
+                edge["way_id"] = highways[i].way_id
         except:
             print('', end='')
     return digraph
 
 
-def new_itime_attribute(digraph):
+def new_itime_attribute(digraph, model=None, hour=None):
     """Function that for every edge in the "digraph", it creates a new
     attribute called "itime" which represents the aproximate time needed to
     travel through this edge.
@@ -280,59 +406,72 @@ def new_itime_attribute(digraph):
     is of d/v. This will happen in perfect conditions but we need to consider
     that there can be congestions or other factors that wouldn't allow us to
     travel at the maximum speed through all the edge.
-    We have decided to manipulate the value of d/v by multiplying it by a
-    factor c which depends on the congestion of the edge. Also, we decided to
-    multiply this value by 2 in other to consider these other factors as
-    traffic lights or pedestrians.
-    Conclusion: itime = (d/v)*c*2
+    We manipulate the value of d/v by multiplying it by a factor f given by
+    the speed "model", which depends on the tramo of the edge, the "hour" of
+    the day and the congestion of the edge.
+    Conclusion: itime = (d/v)*f
+    Note: if no "model" is given, we use the default speed model, in which
+    f = c*2, being c the factor of the congestion of the edge and 2 a factor
+    to consider other factors as traffic lights or pedestrians.
+    Note: if no "hour" is given, we use the actual hour.
     Note: if the edge doesn't have a maximum speed value, we will consider that
-    this value is of 50 km/h.
+    this value is of DEFAULT_SPEED km/h.
     Note: if the edge doesn't have a congestion value, we will consider that
     this value is of 0 "sense dades".
     """
-    # For every edge in the osmnx graph, it creates a new attribute called
-    # "itime" which represents the aproximate time needed to travel through an
-    # edge.
-    for node1, info1 in digraph.nodes.items():
-        for node2, edge in digraph.adj[node1].items():
-            d = float(digraph.edges[node1, node2]["length"])
-            v = 0
-            c = 0
-
-            # As for every edge we don't have the "maxspeed" attribute, we will
-            # consider that if it doesn't exists, the maxspeed is 50 km/h.
-            try:
-                v = float(digraph.edges[node1, node2]["maxspeed"])
-            except:
-                v = 50
-            v = v * (1000/3600)  # conversion factor to m/s
-
-            # As for every edge we don't have the "congestion" attribute, we
-            # will consider that if it doesn't exists, its value is 0 ("sense
-            # dades").
-            try:
-                c = float(digraph.edges[node1, node2]["congestion"])
-            except:
-                c = 0  # sense dades
-            digraph.edges[node1, node2]["itime"] = (d/v) * _factor(c) * 2
+    if model is None:
+        model = default_speed_model()
+    if hour is None:
+        hour = time.localtime().tm_hour
+
+    # It collects the attributes of all the edges of the osmnx graph so that
+    # the "itime" of all of them is computed at once.
+    edges = [edge for node1, node2, edge in digraph.edges(data=True)]
+    d = np.array([float(edge["length"]) for edge in edges])
+    v = np.array([_maxspeed(edge) for edge in edges])
+    v = v * (1000/3600)  # conversion factor to m/s
+    c = [int(edge.get("congestion", 0)) for edge in edges]
+    way_ids = [edge.get("way_id") for edge in edges]
+    itimes = (d/v) * speed_factors(model, way_ids, c, hour)
+
+    # For every edge, it creates the new attribute called "itime".
+    for edge, itime in zip(edges, itimes.tolist()):
+        edge["itime"] = itime
     return digraph
 
 
-def build_igraph(digraph, highways, congestions):
+def build_igraph(digraph, highways, congestions, model=None):
     """Function that builds an intelligent graph adding a new attribute to the
     edges of our "digraph" called "itime" in which we compute the approximate
     time to travel trough an edge. This value depends on the list of
-    "congestions" of the "highways".
+    "congestions" of the "highways" and on the speed "model" used.
     """
     # It spreads the congestions of the highways to the osmnx graph.
     con_digraph = spread_congestions(digraph, highways, congestions)
 
-    # It creates the new attribute for every edge of the graph named "itime".
-    igraph = new_itime_attribute(con_digraph)
+    # It creates the new attribute for every edge of the graph named "itime",
+    # for the hour in which the congestions were collected.
+    hour = _congestions_hour(congestions)
+    igraph = new_itime_attribute(con_digraph, model, hour)
 
     return igraph
 
 
+def get_nearest_node(igraph, ubi):
+    """Function that given the "igraph" and a location with its coordinates
+    ("ubi"), returns the closest node of the igraph to this location.
+    """
+    return ox.nearest_nodes(igraph, ubi[1], ubi[0])
+
+
+def get_shortest_path_between_nodes(igraph, origin, destination):
+    """Function that given the "igraph" and two of its nodes returns a list of
+    nodes corresponding to the fastest path to go from "origin" to
+    "destination" depending on the "itime" attribute of every edge.
+    """
+    return nx.shortest_path(igraph, origin, destination, "itime")
+
+
 def get_shortest_path_with_ispeeds(igraph, actual_ubi, desti_ubi):
     """Function that given the "igraph" and two locations with its coordinates
     returns a list of nodes corresponding to the fastest path to go from
@@ -340,12 +479,12 @@ def get_shortest_path_with_ispeeds(igraph, actual_ubi, desti_ubi):
     edge.
     """
     # It looks for the closest nodes in the igraph of the locations given.
-    origin = ox.nearest_nodes(igraph, actual_ubi[1], actual_ubi[0])
-    destination = ox.nearest_nodes(igraph, desti_ubi[1], desti_ubi[0])
+    origin = get_nearest_node(igraph, actual_ubi)
+    destination = get_nearest_node(igraph, desti_ubi)
 
     # It computes the shortest path taking into account the "itime" attribute.
     # The return of this function is a list of nodes of the osmnx graph.
-    path = nx.shortest_path(igraph, origin, destination, "itime")
+    path = get_shortest_path_between_nodes(igraph, origin, destination)
 
     return path
 
@@ -356,8 +495,8 @@ def get_path_time(igraph, actual_ubi, desti_ubi):
     "desti_ubi".
     """
     # It looks for the closest nodes in the igraph of the locations given.
-    origin = ox.nearest_nodes(igraph, actual_ubi[1], actual_ubi[0])
-    destination = ox.nearest_nodes(igraph, desti_ubi[1], desti_ubi[0])
+    origin = get_nearest_node(igraph, actual_ubi)
+    destination = get_nearest_node(igraph, desti_ubi)
 
     # It computes the shortest path taking into account the "itime" attribute
     # and calculates the time to travel through this path.
@@ -366,6 +505,16 @@ def get_path_time(igraph, actual_ubi, desti_ubi):
     return path_time
 
 
+def get_path_itime(igraph, path):
+    """Function that given the "igraph" and a "path", returns the time in
+    seconds to travel through this path.
+    """
+    itime = 0
+    for i in range(len(path)-1):
+        itime += igraph.edges[path[i], path[i+1]]["itime"]
+    return itime
+
+
 def get_path_length(igraph, path):
     """Function that given the "igraph" and a "path", returns the length in
     meters of this path.
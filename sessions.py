@@ -0,0 +1,223 @@
+import collections
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+
+SESSIONS_FILENAME = 'sessions.db'
+MAX_SESSIONS = 1000  # sessions kept in memory
+SESSION_TTL = 7*24*60*60  # seconds without activity before a session expires
+
+
+# We define this tuple to save the session of a user. For every user, we save:
+# its location ("actual_ubi") and the nearest node of the graph to it
+# ("node"), its last destination ("desti_ubi") and its nearest node
+# ("desti_node"), the last route computed between them ("route") and the time
+# when this route was computed ("route_time").
+Session = collections.namedtuple('Session', 'actual_ubi node desti_ubi \
+desti_node route route_time', defaults=(None,)*6)
+
+
+def _memory_size(value):
+    """Function that returns an estimation of the memory in bytes used by a
+    "value", adding the size of the elements of the tuples and lists (as the
+    coordinates of the locations or the nodes of the routes) to their own.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(_memory_size(element) for element in value)
+    return size
+
+
+class SessionStore:
+    """Class that saves the sessions of the users. The most recently used
+    sessions are kept in memory (at most "capacity" of them) and all of them
+    are saved in a SQLite database in the file "file_name", so that they are
+    not lost when the bot restarts. The sessions that have not been used for
+    "ttl" seconds expire.
+    It can be used by different handlers at the same time.
+    """
+
+    def __init__(self, file_name=SESSIONS_FILENAME, capacity=MAX_SESSIONS,
+                 ttl=SESSION_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        # For every session in memory, we save the session, the time of its
+        # last use and an estimation of the memory it uses. The order of
+        # the dictionary is the order of use, the last one being the most
+        # recently used.
+        self._sessions = collections.OrderedDict()
+
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (chat_id '
+                         'INTEGER PRIMARY KEY, data BLOB, time REAL)')
+        self._db.commit()
+
+        self._operations = 0
+        self._hits = 0
+        self._latency = 0
+        self._max_latency = 0
+
+    def get(self, chat_id):
+        """Function that returns the session of the user of the chat
+        "chat_id". If it doesn't exist or it has expired, it returns None.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            session = self._get(chat_id, time.time())
+            self._measure(start)
+        return session
+
+    def update(self, chat_id, **fields):
+        """Function that updates the given "fields" of the session of the user
+        of the chat "chat_id", creating it if it doesn't exist, and returns
+        the new session.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            now = time.time()
+            session = self._get(chat_id, now) or Session()
+            session = session._replace(**fields)
+            self._put(chat_id, session, now)
+            self._measure(start)
+        return session
+
+    def update_if(self, chat_id, expected, **fields):
+        """Function that updates the given "fields" of the session of the user
+        of the chat "chat_id" only if the session exists and its fields have
+        the values of the dictionary "expected". Returns the new session, or
+        None if it has not been updated.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            now = time.time()
+            session = self._get(chat_id, now)
+            if session is not None and all(getattr(session, field) == value
+                                           for field, value in
+                                           expected.items()):
+                session = session._replace(**fields)
+                self._put(chat_id, session, now)
+            else:
+                session = None
+            self._measure(start)
+        return session
+
+    def delete(self, chat_id):
+        """Function that deletes the session of the user of the chat
+        "chat_id".
+        """
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+            self._db.execute('DELETE FROM sessions WHERE chat_id = ?',
+                             (chat_id,))
+            self._db.commit()
+
+    def purge(self):
+        """Function that deletes all the expired sessions, both from memory
+        and from the database.
+        """
+        with self._lock:
+            # The times of the last use of the sessions in memory are saved in
+            # the database first, so that both expire with the same times.
+            self._save_times(self._sessions.items())
+            limit = time.time() - self.ttl
+            for chat_id, (session, used, size) in list(self._sessions.items()):
+                if used < limit:
+                    del self._sessions[chat_id]
+            self._db.execute('DELETE FROM sessions WHERE time < ?', (limit,))
+            self._db.commit()
+
+    def metrics(self):
+        """Function that returns a dictionary with the number of sessions in
+        memory and in the database, the approximate memory footprint of the
+        sessions in memory (in bytes), the hit ratio of the memory and the
+        mean and maximum latency of the operations (in seconds).
+        """
+        with self._lock:
+            stored = self._db.execute('SELECT COUNT(*) FROM sessions')
+            operations = max(self._operations, 1)
+            return {
+                'sessions': len(self._sessions),
+                'stored': stored.fetchone()[0],
+                'bytes': sum(size for s, u, size in self._sessions.values()),
+                'hit_ratio': self._hits / operations,
+                'mean_latency': self._latency / operations,
+                'max_latency': self._max_latency,
+            }
+
+    def close(self):
+        """Function that saves the times of the last use of the sessions in
+        memory and closes the database of the sessions.
+        """
+        with self._lock:
+            self._save_times(self._sessions.items())
+            self._db.close()
+
+    def _get(self, chat_id, now):
+        """Function that returns the session of the chat "chat_id", looking
+        for it in memory and, if it is not there, in the database. It must be
+        called with the lock acquired.
+        """
+        self._operations += 1
+        if chat_id in self._sessions:
+            session, used, size = self._sessions[chat_id]
+            if now - used < self.ttl:
+                self._hits += 1
+                self._sessions[chat_id] = (session, now, size)
+                self._sessions.move_to_end(chat_id)
+                return session
+            del self._sessions[chat_id]
+
+        row = self._db.execute('SELECT data, time FROM sessions WHERE '
+                               'chat_id = ?', (chat_id,)).fetchone()
+        if row is None or now - row[1] >= self.ttl:
+            return None
+        session = Session(*pickle.loads(row[0]))
+        self._remember(chat_id, session, now)
+        return session
+
+    def _save_times(self, sessions):
+        """Function that saves in the database the time of the last use of the
+        given "sessions" (pairs of chat_id and memory entry). The reads of the
+        sessions only update this time in memory, so that they don't need to
+        write in the database. It must be called with the lock acquired.
+        """
+        self._db.executemany(
+            'UPDATE sessions SET time = ? WHERE chat_id = ? AND time < ?',
+            [(used, chat_id, used) for chat_id, (s, used, size) in sessions])
+        self._db.commit()
+
+    def _put(self, chat_id, session, now):
+        """Function that saves the "session" of the chat "chat_id" in memory
+        and in the database. It must be called with the lock acquired.
+        """
+        # The session is saved as a tuple so that it can be loaded even if
+        # the definition of Session changes.
+        data = pickle.dumps(tuple(session))
+        self._db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                         (chat_id, data, now))
+        self._db.commit()
+        self._remember(chat_id, session, now)
+
+    def _remember(self, chat_id, session, now):
+        """Function that keeps the "session" of the chat "chat_id" in memory,
+        forgetting the least recently used session if there are too many.
+        It must be called with the lock acquired.
+        """
+        self._sessions[chat_id] = (session, now, _memory_size(session))
+        self._sessions.move_to_end(chat_id)
+        forgotten = []
+        while len(self._sessions) > self.capacity:
+            forgotten.append(self._sessions.popitem(last=False))
+        if forgotten:
+            self._save_times(forgotten)
+
+    def _measure(self, start):
+        """Function that adds the time since "start" to the latency metrics.
+        """
+        latency = time.perf_counter() - start
+        self._latency += latency
+        self._max_latency = max(self._max_latency, latency)